@@ -1,13 +1,35 @@
+import errno
+import io
+import itertools
 import logging
 import os
 import sqlite3
 import sys
+import threading
+import time
 import zlib
 
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from functools import lru_cache, partial
 from enum import Enum, auto
 from pathlib import Path
 
+try:
+    import deflate as _libdeflate
+except ImportError:
+    _libdeflate = None
+
+try:
+    from isal import isal_zlib as _isal_zlib
+except ImportError:
+    _isal_zlib = None
+
+try:
+    import zstandard as _zstd
+except ImportError:
+    _zstd = None
+
 
 logger = logging.getLogger(__name__)
 
@@ -16,6 +38,7 @@ class Compression(Enum):
     """Constants for choosing compression type."""
     SQLAR_STORED = auto()
     SQLAR_DEFLATED = auto()
+    SQLAR_ZSTD = auto()
 
 
 SQLAR_STORED = Compression.SQLAR_STORED
@@ -24,6 +47,9 @@ SQLAR_STORED = Compression.SQLAR_STORED
 SQLAR_DEFLATED = Compression.SQLAR_DEFLATED
 """Alias for `Compression.SQLAR_DEFLATED`."""
 
+SQLAR_ZSTD = Compression.SQLAR_ZSTD
+"""Alias for `Compression.SQLAR_ZSTD`."""
+
 _SQLAR_TABLE_SCHEMA = """
 CREATE TABLE IF NOT EXISTS sqlar(
     name TEXT PRIMARY KEY, -- name of the file
@@ -33,27 +59,211 @@ CREATE TABLE IF NOT EXISTS sqlar(
     data BLOB -- compressed content
 )"""
 
-_SQLAR_TABLE_INFO_EXPECTED_RESULT = [
+_SQLAR_TABLE_INFO_EXPECTED_RESULT = (
     (0, "name", "TEXT", 0, None, 1),
     (1, "mode", "INT", 0, None, 0),
     (2, "mtime", "INT", 0, None, 0),
     (3, "sz", "INT", 0, None, 0),
     (4, "data", "BLOB", 0, None, 0)
-]
+)
+
+_SQLAR_DEFAULT_PRAGMAS = {
+    "page_size": 65536,
+    "auto_vacuum": "INCREMENTAL",
+    "busy_timeout": 5000,
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+    "cache_size": -65536,  # 64 MiB
+    "mmap_size": 1073741824,  # 1 GiB
+}
+
+# Pragmas that change the database file and are skipped for read-only archives
+_SQLAR_WRITE_PRAGMAS = {"journal_mode"}
+
+# Pragmas that only take effect before the first table is created, and have to
+# run before journal_mode=WAL, so they are only applied to new archives
+_SQLAR_CREATE_PRAGMAS = {"page_size", "auto_vacuum"}
+
+_SQLAR_CREATE_WANTED = "CREATE TEMP TABLE IF NOT EXISTS _sqlar_wanted(name TEXT PRIMARY KEY)"
+
+_CHUNK_SIZE = 64 * 1024
+
+# Files larger than this are deflated in chunks of _READ_CHUNK_SIZE by `write`
+_STREAM_COMPRESS_SIZE = 8 * 1024 * 1024
+_READ_CHUNK_SIZE = 256 * 1024
+
+# Upper bound on BLOB bytes held in memory at once by a parallel extractall
+_EXTRACT_BATCH_BYTES = 64 * 1024 * 1024
+
+# Batches with fewer rows than this are extracted on the calling thread
+_MIN_PARALLEL_ROWS = 4
+
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# Inputs shorter than this rarely shrink enough to pay for the zlib framing
+_MIN_COMPRESS_SIZE = 128
+
+# Signatures of formats that are already compressed
+_INCOMPRESSIBLE_MAGICS = (
+    b"\x89PNG",  # PNG
+    b"\xff\xd8\xff",  # JPEG
+    b"GIF8",  # GIF
+    b"PK\x03\x04",  # zip, jar, docx, ...
+    b"\x1f\x8b",  # gzip
+    b"BZh",  # bzip2
+    b"\xfd7zXZ\x00",  # xz
+    b"7z\xbc\xaf\x27\x1c",  # 7z
+    _ZSTD_MAGIC,  # zstd
+)
+
+# Inputs of at least _PROBE_MIN_SIZE bytes are stored as is if the first
+# _PROBE_SIZE bytes do not shrink below _PROBE_RATIO when deflated at level 1
+_PROBE_SIZE = 4096
+_PROBE_MIN_SIZE = 64 * 1024
+_PROBE_RATIO = 0.98
+_ZSTD_DEFAULT_LEVEL = 15
+
+# Statements are kept on a single line, they are the keys of the sqlite3
+# statement cache that is searched on every execute
+_SQLAR_INSERT = "INSERT INTO sqlar(name, mode, mtime, sz, data) VALUES (?, ?, ?, ?, ?)"
+
+_SQLAR_GETINFO = "SELECT name, mode, mtime, sz FROM sqlar WHERE name = ?"
+
+_SQLAR_INFOLIST = "SELECT name, mode, mtime, sz FROM sqlar"
+
+_SQLAR_NAMELIST = "SELECT name FROM sqlar"
+
+_SQLAR_READ = "SELECT sz, data FROM sqlar WHERE name = ?"
+
+_SQLAR_ROWID = "SELECT rowid, data IS NULL FROM sqlar WHERE name = ?"
+
+_SQLAR_SELECT_ROWS = "SELECT {}mode, mtime, sz, data FROM sqlar"
+
+_SQLAR_SELECT_BLOB_ROWS = "SELECT rowid, {}mode, mtime, sz, data IS NULL FROM sqlar"
+
+_SQLAR_WHERE_NAME = " WHERE name = ?"
+
+_SQLAR_COPY = (
+    "INSERT INTO main.sqlar(name, mode, mtime, sz, data) "
+    "SELECT name, mode, mtime, sz, data FROM {}.sqlar"
+)
+
+_SQLAR_COPY_COMPRESSED = (
+    "INSERT INTO main.sqlar(name, mode, mtime, sz, data) "
+    "SELECT name, mode, mtime, sz, "
+    "CASE WHEN sz = length(data) THEN sqlar_compress(data) ELSE data END "
+    "FROM {}.sqlar"
+)
+
+_SQLAR_WHERE_IN = " WHERE name IN ({})"
+
+_SQLAR_WHERE_WANTED = " WHERE name IN (SELECT name FROM temp._sqlar_wanted)"
+
+_SQLAR_CLEAR_WANTED = "DELETE FROM temp._sqlar_wanted"
+
+_SQLAR_INSERT_WANTED = "INSERT OR IGNORE INTO temp._sqlar_wanted VALUES (?)"
+
+# Longer member lists are matched through a temporary table
+_MAX_INLINE_MEMBERS = 64
+
+# Size of the per-connection prepared statement cache
+_SQLAR_CACHED_STATEMENTS = 256
+
 
 class SQLiteArchiveException(Exception):
     pass
 
 
 def _get_deflated_decompressor():
-    return zlib.decompressobj(wbits=-zlib.MAX_WBITS)
+    # sqlar stores zlib streams (header and adler32 footer), not raw deflate
+    return zlib.decompressobj(wbits=zlib.MAX_WBITS)
 
 
 def _get_deflated_compressor(level=-1):
-    return zlib.compressobj(level=level, method=zlib.DEFLATED, wbits=-zlib.MAX_WBITS)
+    # Produces the same stream as zlib.compress, which is what sqlar stores.
+    # A fresh object is cheaper than copying a preconfigured one, since
+    # compressobj.copy() duplicates the full window and hash state.
+    return zlib.compressobj(level=level, method=zlib.DEFLATED, wbits=zlib.MAX_WBITS)
+
+
+# Whole-buffer zlib backends. libdeflate and ISA-L produce and accept regular
+# zlib streams, so archives stay readable by the sqlite3 command-line tool.
+if _libdeflate is not None:
+    def _zlib_compress(data, level):
+        # libdeflate has no "default" level, use zlib's default of 6
+        if level == zlib.Z_DEFAULT_COMPRESSION:
+            level = 6
+        return _libdeflate.zlib_compress(data, level)
+
+    def _zlib_decompress(data, size):
+        # libdeflate needs the exact output size, which sqlar stores in `sz`
+        return _libdeflate.zlib_decompress(data, size)
+elif _isal_zlib is not None:
+    def _zlib_compress(data, level):
+        # ISA-L only implements levels 0-3
+        if level == zlib.Z_DEFAULT_COMPRESSION:
+            level = _isal_zlib.ISAL_DEFAULT_COMPRESSION
+        return _isal_zlib.compress(data, min(level, _isal_zlib.ISAL_BEST_COMPRESSION))
+
+    def _zlib_decompress(data, size):
+        return _isal_zlib.decompress(data, _isal_zlib.MAX_WBITS, size)
+else:
+    def _zlib_compress(data, level):
+        return zlib.compress(data, level)
+
+    def _zlib_decompress(data, size):
+        # sizing the output buffer up front avoids repeated grow-and-copy
+        return zlib.decompress(data, zlib.MAX_WBITS, size)
 
+# Whether _zlib_decompress is faster than streaming through zlib
+_FAST_ZLIB = _libdeflate is not None or _isal_zlib is not None
 
-def compress_data(data, level=None):
+
+# ZstdCompressor/ZstdDecompressor instances are expensive to set up but must not
+# be used from several threads at once, so each thread keeps its own.
+_zstd_local = threading.local()
+
+
+def _require_zstd():
+    if _zstd is None:
+        raise SQLiteArchiveException("SQLAR_ZSTD requires the zstandard package")
+
+
+def _zstd_compress(data, level):
+    _require_zstd()
+    compressors = getattr(_zstd_local, "compressors", None)
+    if compressors is None:
+        compressors = _zstd_local.compressors = {}
+    compressor = compressors.get(level)
+    if compressor is None:
+        compressor = compressors[level] = _zstd.ZstdCompressor(level=level)
+    return compressor.compress(data)
+
+
+def _zstd_decompressor():
+    _require_zstd()
+    decompressor = getattr(_zstd_local, "decompressor", None)
+    if decompressor is None:
+        decompressor = _zstd_local.decompressor = _zstd.ZstdDecompressor()
+    return decompressor
+
+
+def _looks_incompressible(data, size):
+    """Cheaply guess from the start of *data* whether compressing will pay off.
+
+    Args:
+        data: The first bytes, at least `_PROBE_SIZE` of them if available.
+        size: The size of the complete input.
+    """
+    if size < _MIN_COMPRESS_SIZE or bytes(data[:8]).startswith(_INCOMPRESSIBLE_MAGICS):
+        return True
+    if size >= _PROBE_MIN_SIZE:
+        head = data[:_PROBE_SIZE]
+        return len(zlib.compress(head, 1)) > _PROBE_RATIO * len(head)
+    return False
+
+
+def compress_data(data, level=None, compression=SQLAR_DEFLATED):
     """Compress data for storage in archive.
 
     The behaviour is the same as
@@ -62,27 +272,90 @@ def compress_data(data, level=None):
     header and CRC footer. If the compressed data is smaller than the original
     it is returned otherwise the original data is returned.
 
+    Data shorter than 128 bytes or starting with the signature of an already
+    compressed format (PNG, JPEG, zip, gzip, ...) is returned without trying to
+    compress it. For data of 64 KiB or more the first 4 KiB are trial
+    compressed at the fastest level, and if they do not shrink by at least 2%
+    the data is considered incompressible as well.
+
+    If the optional [*deflate*](https://pypi.org/project/deflate/) (libdeflate)
+    or [*isal*](https://pypi.org/project/isal/) package is installed it is used
+    instead of *zlib*. Note that ISA-L only supports levels 0-3, higher levels
+    are clamped to 3.
+
+    With `SQLAR_ZSTD` the data is compressed to a Zstandard frame instead,
+    which requires the optional
+    [*zstandard*](https://pypi.org/project/zstandard/) package. Such archives
+    can only be read by *pysqlar*, not by the `sqlite3` command-line tool.
+
     Args:
         data: The data to compress.
-        level (optional): The level of compression, see the *zlib* documentation
-            for allowed values. If it is `None`, `zlib.Z_DEFALUT_COMPRESSION`
-            is used.
+        level (optional): The level of compression, see the *zlib* or
+            *zstandard* documentation for allowed values. If it is `None`,
+            `zlib.Z_DEFAULT_COMPRESSION` or zstd level 15 is used.
+        compression (optional): `SQLAR_DEFLATED` or `SQLAR_ZSTD`.
 
     Returns:
         The compressed data if it is smaller than the original, otherwise the
         original data.
     """
-    level = level if level else zlib.Z_DEFAULT_COMPRESSION
+    if _looks_incompressible(data, len(data)):
+        return data
 
-    compressed_data = zlib.compress(data, level=level)
+    if compression == SQLAR_ZSTD:
+        level = level if level is not None else _ZSTD_DEFAULT_LEVEL
+        compressed_data = _zstd_compress(data, level)
+    else:
+        level = level if level is not None else zlib.Z_DEFAULT_COMPRESSION
+        compressed_data = _zlib_compress(data, level)
     return compressed_data if len(compressed_data) < len(data) else data
 
 
+def _compress_file(f, size, level=None, compression=SQLAR_DEFLATED):
+    """Compress the open file *f* of *size* bytes like `compress_data`.
+
+    Large files are fed to a zlib compressor chunk by chunk so that only the
+    compressed output is held in memory, instead of the whole file plus its
+    compressed copy. Small files and other codecs use the whole-buffer path,
+    which is faster with the optional backends.
+    """
+    if compression != SQLAR_DEFLATED or size <= _STREAM_COMPRESS_SIZE:
+        return compress_data(f.read(), level, compression)
+
+    # read into one reused buffer rather than allocating bytes per chunk
+    buf = bytearray(_READ_CHUNK_SIZE)
+    view = memoryview(buf)
+
+    n = f.readinto(buf)
+    if _looks_incompressible(view[:n], size):
+        f.seek(0)
+        return f.read()
+
+    level = level if level is not None else zlib.Z_DEFAULT_COMPRESSION
+    compressor = _get_deflated_compressor(level)
+    compressed_data = bytearray()
+    while n:
+        compressed_data += compressor.compress(view[:n])
+        if len(compressed_data) >= size:
+            # the output is already too large, give up early
+            break
+        n = f.readinto(buf)
+    else:
+        compressed_data += compressor.flush()
+        if len(compressed_data) < size:
+            return compressed_data
+
+    # rare, but the file has to be stored as is
+    f.seek(0)
+    return f.read()
+
+
 def decompress_data(data, size):
     """Decompress data compressed with `compress_data`.
 
     If the size of the data is the same as *size* the data is assumed to be
-    uncompressed and is returned directly.
+    uncompressed and is returned directly. Zstandard compressed data is
+    recognised by its frame header, anything else is inflated with zlib.
 
     Args:
         data: The data to be decompressed.
@@ -93,33 +366,330 @@ def decompress_data(data, size):
     """
     if size == len(data):
         return data
+    elif data[:4] == _ZSTD_MAGIC:
+        return _zstd_decompressor().decompress(data, max_output_size=size)
     else:
-        return zlib.decompress(data)
+        return _zlib_decompress(data, size)
+
+
+def _iter_decompressed(data, size):
+    """Yield the decompressed content of *data* in chunks.
+
+    Args:
+        data: A bytes-like object or a file-like `sqlite3.Blob`.
+        size: The original size of the data.
+    """
+    length = len(data)
+    read = data.read if hasattr(data, "read") else io.BytesIO(data).read
+
+    first = read(_CHUNK_SIZE)
+    chunks = iter(lambda: read(_CHUNK_SIZE), b"")
+
+    if size == length:
+        yield first
+        for chunk in chunks:
+            yield chunk
+    elif first[:4] == _ZSTD_MAGIC:
+        decompressor = _zstd_decompressor().decompressobj()
+        yield decompressor.decompress(first)
+        for chunk in chunks:
+            yield decompressor.decompress(chunk)
+    else:
+        # Cap each output chunk so a highly compressed input does not inflate
+        # into one large buffer.
+        decompressor = _get_deflated_decompressor()
+        for chunk in itertools.chain((first,), chunks):
+            while chunk:
+                yield decompressor.decompress(chunk, _CHUNK_SIZE)
+                chunk = decompressor.unconsumed_tail
+        yield decompressor.flush()
+
+
+def _iter_rows(conn, where="", params=(), stream=True, name=True):
+    """Yield `(name, mode, mtime, sz, data)` rows of the *sqlar* table.
+
+    If *name* is false the name is not selected and the rows are
+    `(mode, mtime, sz, data)`, for callers that already know it.
+
+    If *stream* is true and the sqlite3 module supports incremental BLOB I/O,
+    `data` is an open `sqlite3.Blob` that is only valid until the next row is
+    requested, so the content is never loaded into memory in one piece.
+    Otherwise `data` is the fetched BLOB.
+    """
+    columns = "name, " if name else ""
+    if not stream or not hasattr(conn, "blobopen"):
+        for row in conn.execute(_SQLAR_SELECT_ROWS.format(columns) + where, params):
+            yield row
+        return
+
+    rows = conn.execute(_SQLAR_SELECT_BLOB_ROWS.format(columns) + where, params)
+    for rowid, *meta, is_null in rows:
+        if is_null:
+            yield (*meta, None)
+        else:
+            with conn.blobopen("sqlar", "data", rowid, readonly=True) as blob:
+                yield (*meta, blob)
+
+
+def _iter_batches(rows, max_bytes):
+    """Group *rows* into lists holding at most about *max_bytes* of data."""
+    batch = []
+    batch_bytes = 0
+    for row in rows:
+        batch.append(row)
+        batch_bytes += len(row[-1] or b"")
+        if batch_bytes >= max_bytes:
+            yield batch
+            batch = []
+            batch_bytes = 0
+    if batch:
+        yield batch
+
 
-def _decompress_row(path, row):
+# Not available on Windows, where symbolic links are not extracted either
+_O_NOFOLLOW = getattr(os, "O_NOFOLLOW", 0)
+
+# Whether permissions and times can be set on an open file descriptor
+_FD_METADATA = hasattr(os, "fchmod") and os.utime in os.supports_fd
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _write_file(path, mode, mtime, chunks):
+    """Write *chunks* to *path* without a Python file object.
+
+    The permissions and modification time are set on the open descriptor,
+    which saves the separate chmod, stat and utime calls on the path.
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | _O_NOFOLLOW
+    try:
+        fd = os.open(path, flags, mode)
+    except OSError as e:
+        if e.errno != errno.ELOOP:
+            raise
+        # replace a symbolic link, e.g. from an earlier extraction, instead of
+        # writing to wherever it points
+        os.unlink(path)
+        fd = os.open(path, flags, mode)
+    try:
+        for chunk in chunks:
+            _write_all(fd, chunk)
+
+        if _FD_METADATA:
+            os.fchmod(fd, mode)
+            os.utime(fd, times=(time.time(), mtime))
+    finally:
+        os.close(fd)
+
+    if not _FD_METADATA:
+        os.chmod(path, mode)
+        os.utime(path, times=(time.time(), mtime))
+
+
+def _to_arcname(name):
+    """Normalize *name* to a relative archive name with `/` separators."""
+    if (isinstance(name, str)
+            and "//" not in name
+            and "/./" not in name
+            and not name.startswith(("/", "./"))
+            and not name.endswith(("/", "/."))
+            and name != "."
+            and (os.sep == "/" or os.sep not in name)):
+        # already normalized, the common case
+        return name
+
+    name = os.fspath(name)
+    if os.sep != "/":
+        name = name.replace(os.sep, "/")
+    return "/".join(part for part in name.split("/") if part and part != ".")
+
+
+def _check_inside(root, path):
+    """Raise if *path* resolves to a location outside of the directory *root*.
+
+    *root* has to be a real path already.
+    """
+    real = os.path.realpath(path)
+    if real != root and not real.startswith(os.path.join(root, "")):
+        raise SQLiteArchiveException(
+            "{} would be extracted outside of {}".format(path, root)
+        )
+
+
+def _makedirs(path, made_dirs, root=None):
+    """Create the directory *path* unless it is in the set *made_dirs*.
+
+    *path* and all of its ancestors are added to *made_dirs*, so extracting
+    many files into the same directories only creates each directory once.
+    If *root* is given *path* is first checked to not resolve outside of it,
+    for instance through a symbolic link.
+    """
+    if not path or path in made_dirs:
+        return
+    if root is not None:
+        _check_inside(root, path)
+    os.makedirs(path, exist_ok=True)
+    while path and path not in made_dirs:
+        made_dirs.add(path)
+        path = os.path.dirname(path)
+
+
+def _split_item(item):
+    """Split a `writemany` item into `(filename, arcname)`."""
+    return item if isinstance(item, tuple) else (item, None)
+
+
+def _decompress_row(complete_path, mode, mtime, size, data, made_dirs=None,
+                    root=None):
+    made_dirs = made_dirs if made_dirs is not None else set()
+
+    if data is None:
+        # directories are stored with data = NULL
+        _makedirs(complete_path, made_dirs, root)
+        os.chmod(complete_path, mode)
+        os.utime(complete_path, times=(time.time(), mtime))
+        return
+
+    parent = os.path.dirname(complete_path)
+    if size < 0:
+        # symbolic links are stored with sz = -1 and the target as data. Links
+        # created earlier may have changed where the parent resolves to, so it
+        # is always checked.
+        if root is not None and parent:
+            _check_inside(root, parent)
+        _makedirs(parent, made_dirs)
+        target = data.read() if hasattr(data, "read") else data
+        if os.path.lexists(complete_path):
+            os.unlink(complete_path)
+        os.symlink(os.fsdecode(target), complete_path)
+        return
+
+    _makedirs(parent, made_dirs, root)
+
+    if size == len(data) and not hasattr(data, "read"):
+        _write_file(complete_path, mode, mtime, (data,))
+    elif _FAST_ZLIB and not hasattr(data, "read"):
+        # the BLOB is in memory already, inflate it in one call
+        _write_file(complete_path, mode, mtime, (decompress_data(data, size),))
+    else:
+        _write_file(complete_path, mode, mtime, _iter_decompressed(data, size))
+
+
+def _extract_row(path, row, made_dirs=None, root=None):
+    """Extract a `(name, mode, mtime, sz, data)` *row* below *path*."""
     name, mode, mtime, size, data = row
-    complete_path = path / name
-    complete_path.parent.mkdir(parents=True, exist_ok=True)
+    _decompress_row(
+        os.path.join(path, name), mode, mtime, size, data, made_dirs, root
+    )
+
+
+def _defer_symlinks(rows, links):
+    """Yield the *rows* that are not symbolic links, collect those in *links*.
+
+    Extracting the links last means no member is written through a link that
+    is part of the same archive.
+    """
+    for row in rows:
+        name, mode, mtime, size, data = row
+        if size < 0 and data is not None:
+            target = data.read() if hasattr(data, "read") else data
+            links.append((name, mode, mtime, size, target))
+        else:
+            yield row
+
+
+def _apply_pragmas(conn, mode, pragmas=None, create=False):
+    """Apply the default and the given *pragmas* to *conn*.
+
+    With *create* only the pragmas that have to be set before the *sqlar*
+    table is created are applied, and only if the database is new. Otherwise
+    all other pragmas are applied.
+    """
+    settings = dict(_SQLAR_DEFAULT_PRAGMAS)
+    settings.update(pragmas or {})
+
+    if create and not ("w" in mode and conn.execute("PRAGMA page_count").fetchone()[0] == 0):
+        return
+
+    for name, value in settings.items():
+        if value is None:
+            continue
+        if (name in _SQLAR_CREATE_PRAGMAS) != create:
+            continue
+        if name in _SQLAR_WRITE_PRAGMAS and "w" not in mode:
+            continue
+        conn.execute("PRAGMA {}={}".format(name, value))
+
+
+def _sql_compress(data):
+    if data is None:
+        return None
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return compress_data(data)
+
+
+def _sql_uncompress(data, size):
+    if data is None or size is None or size <= 0:
+        return data
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return decompress_data(data, size)
+
+
+def _create_function(conn, name, nargs, func):
+    try:
+        conn.create_function(name, nargs, func, deterministic=True)
+    except (TypeError, sqlite3.NotSupportedError):
+        # deterministic needs Python 3.8 and SQLite 3.8.3
+        conn.create_function(name, nargs, func)
+
+
+@lru_cache(maxsize=256)
+def _cached_uri(filename, mode, cwd):
+    if mode == "memory":
+        uri = "file:{}".format(filename)
+    else:
+        uri = Path(cwd or "", filename).as_uri()
+    return "{}?mode={}".format(uri, mode)
 
-    with open(complete_path, "wb") as f:
-        f.write(decompress_data(data, size))
-    
-    complete_path.chmod(mode)
-    info = complete_path.stat()
-    os.utime(complete_path, times=(info.st_atime, mtime))
 
+def _make_uri(filename, mode):
+    """Return the SQLite URI opening *filename* with *mode*.
 
-def _init_archive(filename, mode):
+    Building the URI resolves and percent-encodes the path, so the result is
+    cached. Relative paths are keyed on the working directory as well, so the
+    cache stays correct after a `os.chdir`.
+    """
+    path = Path(filename)
+    cwd = None if path.is_absolute() else str(Path.cwd())
+    return _cached_uri(str(path), mode, cwd)
+
+
+def _init_archive(filename, mode, pragmas=None):
     if filename == ":memory:":
-        conn = sqlite3.connect(filename)
+        conn = sqlite3.connect(
+            filename,
+            uri=True,
+            cached_statements=_SQLAR_CACHED_STATEMENTS
+        )
         mode = "rwc"
     else:
-        if mode == "memory":
-            uri = "file:{}".format(filename)
-        else:
-            uri = Path(filename).absolute().as_uri()
+        conn = sqlite3.connect(
+            _make_uri(filename, mode),
+            uri=True,
+            cached_statements=_SQLAR_CACHED_STATEMENTS
+        )
 
-        conn = sqlite3.connect("{}?mode={}".format(uri, mode), uri=True)
+    # plain tuples are the cheapest rows sqlite3 can build
+    conn.row_factory = None
+    _apply_pragmas(conn, mode, pragmas, create=True)
+    _create_function(conn, "sqlar_compress", 1, _sql_compress)
+    _create_function(conn, "sqlar_uncompress", 2, _sql_uncompress)
 
     if "w" in mode or mode == "memory":
         with conn as c:
@@ -129,16 +699,8 @@ def _init_archive(filename, mode):
 
 def _sqlar_table_exists(conn):
     cur = conn.cursor()
-    row = cur.execute("PRAGMA table_info('sqlar')").fetchall()
-
-    if len(row) != len(_SQLAR_TABLE_INFO_EXPECTED_RESULT):
-        return False
-
-    for res, expected in zip(row, _SQLAR_TABLE_INFO_EXPECTED_RESULT):
-        if res != expected:
-            return False
-
-    return True
+    rows = cur.execute("PRAGMA table_info('sqlar')").fetchall()
+    return tuple(rows) == _SQLAR_TABLE_INFO_EXPECTED_RESULT
 
 
 def is_sqlar(filename):
@@ -165,16 +727,20 @@ def is_sqlar(filename):
     if not os.path.exists(filename):
         return False
 
-    flag = False
     try:
-        conn = sqlite3.connect(filename)
-        flag = _sqlar_table_exists(conn)
-    except sqlite3.OperationalError:
+        # read-only, probing must never modify or create the file
+        uri = _make_uri(filename, "ro")
+        conn = sqlite3.connect(uri, uri=True)
+    except sqlite3.DatabaseError:
+        return False
+
+    try:
+        return _sqlar_table_exists(conn)
+    except sqlite3.DatabaseError:
         # if there was an error the file is not a SQLite Archive
-        flag = False
+        return False
     finally:
         conn.close()
-    return flag
 
 
 
@@ -213,7 +779,8 @@ class SQLiteArchive():
                  filename,
                  mode="ro",
                  compression=SQLAR_STORED,
-                 compress_level=None):
+                 compress_level=None,
+                 pragmas=None):
         """Open a SQLite Archive.
 
         Args:
@@ -227,25 +794,59 @@ class SQLiteArchive():
                 for more information
             compression (optional): Controls the compression of the archive.
                 Allowed values are `SQLAR_STORED` which stores the data
-                uncompressed in the archive and `SQLAR_DEFLATED` which stores
-                data in zlib deflated compressed format.
+                uncompressed in the archive, `SQLAR_DEFLATED` which stores
+                data in zlib deflated compressed format and `SQLAR_ZSTD` which
+                stores data in Zstandard format (requires *zstandard*, not
+                readable by the `sqlite3` command-line tool).
             compress_level (optional): The compression level to use, see *zlib*
                 documentation for allowed values. If compression is
                 `SQLAR_DEFLATED` the default is
-                `zlib.Z_DEFAULT_COMPRESSION`.
+                `zlib.Z_DEFAULT_COMPRESSION`, for `SQLAR_ZSTD` it is 15.
+            pragmas (optional): A mapping of SQLite pragmas to set on the
+                connection, overriding the defaults. By default the archive
+                uses `synchronous=NORMAL`, a 64 MiB page cache and a 1 GiB
+                memory map. New archives are created with 64 KiB pages and
+                incremental auto-vacuum. Give a pragma the value `None` to
+                leave it at the SQLite default. `journal_mode` is only changed
+                for writable archives, pass `{"journal_mode": "WAL"}` for
+                faster writes. Note that WAL is stored in the database file,
+                which then needs a writable directory even to be read. The
+                memory map is silently disabled by SQLite builds where
+                `SQLITE_MAX_MMAP_SIZE` is 0.
         
         Raises:
             `SQLiteArchiveException` if the *filename* is not a SQLite Archive.
         """
         self.filename = filename
-        self._conn, self.mode = _init_archive(filename, mode)
+        self._conn, self.mode = _init_archive(filename, mode, pragmas)
         if not _sqlar_table_exists(self._conn):
+            self._conn.close()
             raise SQLiteArchiveException("{} is not a sqlite archive".format(self.filename))
+        # only touch databases that turned out to be archives
+        _apply_pragmas(self._conn, self.mode, pragmas)
         self._compression = compression
         self._compress_level = compress_level
+        self._in_transaction = False
+        # Reused for single-row lookups, which are fetched immediately.
+        # Creating a cursor per call is a large part of a point lookup.
+        self._cursor = self._conn.cursor()
 
     def close(self):
-        """Close the database."""
+        """Close the database.
+
+        Writable archives run `PRAGMA optimize` first so that the query
+        planner statistics stay up to date, and return pages freed by deleted
+        members to the file system with `PRAGMA incremental_vacuum`.
+        """
+        if "w" in self.mode:
+            # best effort, e.g. the archive may already be closed or locked
+            with suppress(sqlite3.Error):
+                self._conn.execute("PRAGMA optimize")
+            if not self._in_transaction:
+                # frees one page per step, execute would only run the first,
+                # and executescript would commit an unfinished transaction
+                with suppress(sqlite3.Error):
+                    self._conn.executescript("PRAGMA incremental_vacuum")
         self._conn.close()
     
     def getinfo(self, name):
@@ -258,34 +859,15 @@ class SQLiteArchive():
             Metadata for file *name* or `None` if there is no such file in the
             archive.
         """
-        with self._conn as c:
-            row = c.execute(
-                """
-                SELECT name, mode, mtime, sz FROM sqlar WHERE name = ?;
-                """,
-                (name,)
-            ).fetchone()
-        return row
+        return self._cursor.execute(_SQLAR_GETINFO, (name,)).fetchone()
 
     def infolist(self):
         """Returns a list of metadata for all files in the archive."""
-        with self._conn as c:
-            rows = c.execute(
-                """
-                SELECT name, mode, mtime, sz FROM sqlar;
-                """
-            ).fetchall()
-        return rows
+        return self._conn.execute(_SQLAR_INFOLIST).fetchall()
 
     def namelist(self):
         """Returns a list of all files in the archive."""
-        with self._conn as c:
-            rows = c.execute(
-                """
-                SELECT name FROM sqlar;
-                """
-            ).fetchall()
-        return list(*zip(*rows)) # unpack [(item1,), (item2,), ...] to [item1, item2, ...]
+        return [name for (name,) in self._conn.execute(_SQLAR_NAMELIST)]
 
     def open(self, name, mode="r"):
         raise NotImplementedError()
@@ -299,72 +881,150 @@ class SQLiteArchive():
             member: The archive member to extract.
             path (optional): The root path to extract the archive to.
         """
-        path = Path(path) if path else Path()
-
-        with self._conn as c:
-            row = c.execute(
-                """
-                SELECT * FROM sqlar WHERE name = ?;
-                """,
-                (member,)
-            ).fetchone()
-        if row:
-            _decompress_row(path, row)
+        path = os.fspath(path) if path else ""
+        root = os.path.realpath(path or os.curdir)
 
-    def extractall(self, path=None, members=None):
+        complete_path = os.path.join(path, member)
+        rows = _iter_rows(self._conn, _SQLAR_WHERE_NAME, (member,), name=False)
+        for mode, mtime, size, data in rows:
+            _decompress_row(complete_path, mode, mtime, size, data, root=root)
+
+    def extractall(self, path=None, members=None, workers=None):
         """Extract the entire archive.
 
         Defaults to extracting in *cwd*.
 
+        Members are decompressed and written by a pool of *workers* threads.
+        The rows are read from the database in batches of up to 64 MiB, which
+        are handed to the pool one at a time. With `workers=1` every member is
+        instead streamed from the database in small chunks.
+
+        Symbolic links are created after all other members, and no member is
+        written to a directory that resolves outside of *path*. Existing files
+        and links are replaced.
+
         Args:
             path (optional): The root path to extract the archive to.
-            members (optional): A list of member files to extract. Has to be
-                shorter than 999 members.
+            members (optional): A list of member files to extract.
+            workers (optional): The number of threads to use, defaults to
+                `os.cpu_count()`.
 
         Raises:
-            ValueError: If `len(members) > 1000`.
+            `SQLiteArchiveException` if a member would be extracted outside of
+            *path*.
         """
-        if members and len(members) > 1000:
-            raise ValueError("can only extract 999 or less named members.")
-        path = Path(path) if path else Path()
-
-        with self._conn as c:
-            if members:
-                cur = c.execute(
-                    """
-                    SELECT * FROM sqlar WHERE name IN ({});
-                    """.format('?,'.join('' for _ in members)),
-                    members
+        path = os.fspath(path) if path else ""
+
+        workers = workers or os.cpu_count() or 1
+
+        members = list(members) if members else []
+        params = ()
+
+        if members and len(members) <= _MAX_INLINE_MEMBERS:
+            where = _SQLAR_WHERE_IN.format(",".join("?" * len(members)))
+            params = members
+        elif members:
+            # A temporary table avoids the bound parameter limit of an IN list
+            # and lets SQLite look each member up by the primary key.
+            with self._committing() as c:
+                c.execute(_SQLAR_CREATE_WANTED)
+                c.execute(_SQLAR_CLEAR_WANTED)
+                c.executemany(
+                    _SQLAR_INSERT_WANTED,
+                    ((member,) for member in members)
                 )
-            else:
-                cur = c.execute(
-                    """
-                    SELECT * FROM sqlar;
-                    """
-                )
-            for row in cur:
-                _decompress_row(path, row)
+            where = _SQLAR_WHERE_WANTED
+        else:
+            where = ""
+
+        made_dirs = set()
+        root = os.path.realpath(path or os.curdir)
+        links = []
 
-    def read(self, name):
+        if workers == 1:
+            rows = _iter_rows(self._conn, where, params)
+            for row in _defer_symlinks(rows, links):
+                _extract_row(path, row, made_dirs, root)
+        else:
+            # sqlite3 objects must stay on this thread, so rows are fetched here
+            # and only the decompression and file I/O runs in the pool.
+            rows = _iter_rows(self._conn, where, params, stream=False)
+            extract_row = partial(
+                _extract_row, path, made_dirs=made_dirs, root=root
+            )
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                rows = _defer_symlinks(rows, links)
+                for batch in _iter_batches(rows, _EXTRACT_BATCH_BYTES):
+                    if len(batch) < _MIN_PARALLEL_ROWS:
+                        # not worth handing off (and starting threads for)
+                        for row in batch:
+                            extract_row(row)
+                    else:
+                        for _ in executor.map(extract_row, batch):
+                            pass
+
+        for row in links:
+            _extract_row(path, row, made_dirs, root)
+
+    def read(self, name, raw=False, *, copy=True):
         """Returns a decompressed bytes-object from the archive.
 
         Args:
             name: The name of the file to extract.
+            raw (optional): Return the data as it is stored in the archive
+                instead, together with its original size. Useful to pass
+                compressed data on without inflating it.
+            copy (optional): If false and the file is stored uncompressed, a
+                `memoryview` over the bytes-object of the row is returned, so
+                that slicing it does not copy. Compressed files are returned
+                as decompressed bytes either way. SQLite still copies the data
+                out of the database in both cases.
 
         Returns:
-            A bytes-object with the decompressed file.
+            A bytes-object with the decompressed file, a `memoryview` if *copy*
+            is false and the file is stored, or the tuple `(data, size)` if
+            *raw* is true.
         """
-        with self._conn as c:
-            row = c.execute(
-                """
-                SELECT * FROM sqlar WHERE name = ?;
-                """,
-                (name,)
-            ).fetchone()
+        row = self._read_blob(name)
         if row:
-            _, _, _, size, data = row
+            size, data = row
+            if raw:
+                return data, size
+            if not copy and size == len(data):
+                return memoryview(data)
             return decompress_data(data, size)
 
+    def blob(self, name):
+        """Open the stored data of a file for incremental reading.
+
+        The data is returned exactly as stored, use `getinfo` to find out if it
+        is compressed (`sz` differs from the length of the blob). Only the
+        parts that are read or sliced are copied out of the database. Requires
+        Python 3.11+.
+
+        ```python
+        with ar.blob("file.txt") as blob:
+            header = blob[:16]
+        ```
+
+        Args:
+            name: The name of the file in the archive.
+
+        Returns:
+            A read-only `sqlite3.Blob` or `None` if there is no such file, or
+            the file is a directory.
+
+        Raises:
+            NotImplementedError: If the sqlite3 module does not support
+                incremental BLOB I/O.
+        """
+        if not hasattr(self._conn, "blobopen"):
+            raise NotImplementedError("sqlite3 does not support incremental BLOB I/O")
+
+        row = self._cursor.execute(_SQLAR_ROWID, (name,)).fetchone()
+        if row and not row[1]:
+            return self._conn.blobopen("sqlar", "data", row[0], readonly=True)
+
     def sql(self, query, *args):
         """Execute raw SQL statements against the database.
 
@@ -375,10 +1035,59 @@ class SQLiteArchive():
         Returns:
             The results of the query.
         """
-        with self._conn as c:
+        with self._committing() as c:
             rows = c.execute(query, args).fetchall()
         return rows
 
+    def attach(self, filename, alias):
+        """Attach another database read-only to the archive connection.
+
+        The database can then be queried with `sql` as *alias*, or its members
+        copied with `copy_from`.
+
+        Args:
+            filename: Filename or path-like object of the database to attach.
+            alias: The schema name to attach the database as.
+
+        Raises:
+            ValueError: If *alias* is not a valid identifier.
+        """
+        if not alias.isidentifier():
+            raise ValueError("alias has to be a valid identifier")
+        uri = _make_uri(filename, "ro")
+        self._conn.execute("ATTACH DATABASE ? AS {}".format(alias), (uri,))
+
+    def detach(self, alias):
+        """Detach a database attached with `attach`."""
+        if not alias.isidentifier():
+            raise ValueError("alias has to be a valid identifier")
+        self._conn.execute("DETACH DATABASE {}".format(alias))
+
+    def copy_from(self, alias, compress=False):
+        """Copy all members of the attached archive *alias* into this archive.
+
+        The rows are copied with a single `INSERT ... SELECT` inside SQLite, so
+        by default no data passes through Python. With *compress* uncompressed
+        members are compressed on the way by the `sqlar_compress` SQL function,
+        which is registered on every archive connection, like
+        `sqlar_uncompress`. It is implemented in Python, so each of those
+        members is then passed to Python and back.
+
+        Args:
+            alias: The schema name given to `attach`.
+            compress (optional): Deflate members stored uncompressed in the
+                source archive.
+
+        Raises:
+            ValueError: If *alias* is not a valid identifier.
+            `sqlite3.IntegrityError` if a member already exists in the archive.
+        """
+        if not alias.isidentifier():
+            raise ValueError("alias has to be a valid identifier")
+        query = _SQLAR_COPY_COMPRESSED if compress else _SQLAR_COPY
+        with self._committing() as c:
+            c.execute(query.format(alias))
+
     def testsqlar(self):
         raise NotImplementedError()
 
@@ -405,16 +1114,20 @@ class SQLiteArchive():
             ValueError: *filename* does not represent a file, directory or
                 symlink.
         """
+        self._insert(self._file_row(filename, arcname, compression, compress_level))
+
+    def _file_row(self, filename, arcname, compression, compress_level):
+        """Build the *sqlar* row for `write`."""
         arcname = arcname or filename
 
-        compression = compression or self._compression
-        level = compress_level or self._compress_level
+        compression = compression if compression is not None else self._compression
+        level = compress_level if compress_level is not None else self._compress_level
 
         path = Path(filename)
 
         info = path.stat()
         mode = info.st_mode & 0o777
-        mtime = int(info.st_mtime_ns * 1e-9)
+        mtime = info.st_mtime_ns // 1_000_000_000
         size = info.st_size
 
         if path.is_symlink():
@@ -422,8 +1135,8 @@ class SQLiteArchive():
             size = -1
         elif path.is_file():
             with open(path, "rb") as f:
-                if compression == SQLAR_DEFLATED:
-                    data = compress_data(f.read(), level)
+                if compression != SQLAR_STORED:
+                    data = _compress_file(f, size, level, compression)
                 else:
                     data = f.read()
         elif path.is_dir():
@@ -440,31 +1153,54 @@ class SQLiteArchive():
                 size
             )
         )
-        with self._conn as c:
-            c.execute(
-                """
-                INSERT INTO sqlar(name, mode, mtime, sz, data)
-                VALUES (?, ?, ?, ?, ?)
-                """,
-                (str(Path(arcname).as_posix()), mode, mtime, size, data)
-            )
+        return _to_arcname(arcname), mode, mtime, size, data
+
+    def writemany(self, files, compression=None, compress_level=None):
+        """Write several files to the archive in a single transaction.
+
+        Equivalent to calling `write` for every item inside `transaction`, so
+        all files are inserted with one `executemany` and one commit. The files
+        are read and compressed one at a time as SQLite consumes the rows, so
+        the whole batch is never held in memory. Inside an enclosing
+        `transaction` the files are committed together with that transaction.
+
+        Args:
+            files: An iterable of filenames, path-like objects or
+                `(filename, arcname)` tuples.
+            compression (optional): Override the *compression* chosen when
+                opening the archive.
+            compress_level (optional): Override the *compress_level* chosen when
+                opening the archive.
+        """
+        rows = (
+            self._file_row(*_split_item(item), compression, compress_level)
+            for item in files
+        )
+
+        with self._committing() as c:
+            c.executemany(_SQLAR_INSERT, rows)
 
     def writestr(self,
                  arcname,
                  data,
                  unix_mode=0o777,
-                 mtime=int(datetime.utcnow().timestamp()),
+                 mtime=None,
                  compression=None,
                  compress_level=None):
         """Write the string into the archive with name *arcname*.
 
-        If *data* is a *str* it is first encoded as utf-8 before writing.
+        If *data* is a *str* it is first encoded as utf-8 before writing. Other
+        bytes-like objects, e.g. *bytearray* or *memoryview*, are used as they
+        are instead of being converted to *bytes* first. SQLite copies the data
+        when the row is inserted, so *data* can be reused once `writestr`
+        returns.
 
         Args:
             arcname: The name of the file in the archive.
-            data: The *bytes* or *str* to write to the archive.
+            data: The *str* or bytes-like object to write to the archive.
             unix_mode (optional): The unix file permissions.
-            mtime (optional): The modification time in unix epoch time (seconds).
+            mtime (optional): The modification time in unix epoch time
+                (seconds). Defaults to the current time.
             compression (optional): Override the *compression* chosen when
                 opening the archive.
             compress_level (optional): Override the *compress_level* chosen when
@@ -472,29 +1208,119 @@ class SQLiteArchive():
         """
         if isinstance(data, str):
             data = data.encode("utf-8")
+        elif not isinstance(data, bytes):
+            data = memoryview(data).cast("B")
+
+        if mtime is None:
+            mtime = int(time.time())
+
+        compress_type = compression if compression is not None else self._compression
+        level = compress_level if compress_level is not None else self._compress_level
         
-        compress_type = compression or self._compression
-        level = compress_level or self._compress_level
-        
-        if compress_type == SQLAR_DEFLATED:
-            compressed_data = compress_data(data, level)
+        if compress_type != SQLAR_STORED:
+            compressed_data = compress_data(data, level, compress_type)
         else:
             compressed_data = data
 
-        with self._conn as c:
-            c.execute(
-                """
-                INSERT INTO sqlar(name, mode, mtime, sz, data)
-                VALUES (?, ?, ?, ?, ?)
-                """,
-                (
-                    str(Path(arcname).as_posix()),
-                    unix_mode,
-                    mtime,
-                    len(data),
-                    compressed_data
-                )
+        self._insert(
+            (
+                _to_arcname(arcname),
+                unix_mode,
+                mtime,
+                len(data),
+                compressed_data
             )
+        )
+
+    @contextmanager
+    def transaction(self):
+        """Group writes into a single transaction.
+
+        Files written inside the block are inserted right away, so they can be
+        read back before the block exits, but they are only committed when it
+        exits, paying for one commit instead of one per file. If an exception
+        is raised inside the block the transaction is rolled back and nothing
+        is written. Nested calls join the outermost transaction.
+
+        ```python
+        with ar.transaction():
+            for name, text in files.items():
+                ar.writestr(name, text)
+        ```
+        """
+        if self._in_transaction:
+            yield self
+            return
+
+        self._conn.execute("BEGIN")
+        self._in_transaction = True
+        try:
+            yield self
+        except BaseException:
+            self._conn.rollback()
+            raise
+        else:
+            self._conn.commit()
+        finally:
+            self._in_transaction = False
+
+    @contextmanager
+    def bulk(self):
+        """Group writes into a single transaction without syncing to disk.
+
+        Like `transaction`, but `synchronous=OFF` is set for the duration of
+        the block, and if the archive does not use WAL journaling the rollback
+        journal is kept in memory. The previous settings are restored on exit.
+
+        This trades durability for speed when creating archives from many
+        small files: if the operating system crashes or the power is lost
+        while the rows are being inserted the archive may be corrupted. An
+        exception inside the block still leaves the archive unchanged.
+
+        The settings can not be changed inside a transaction, so inside an
+        enclosing `transaction` or `bulk` block this simply joins it.
+
+        ```python
+        with ar.bulk():
+            for filename in filenames:
+                ar.write(filename)
+        ```
+        """
+        if self._in_transaction:
+            yield self
+            return
+
+        conn = self._conn
+        synchronous = conn.execute("PRAGMA synchronous").fetchone()[0]
+        journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+
+        conn.execute("PRAGMA synchronous=OFF")
+        if journal_mode != "wal":
+            conn.execute("PRAGMA journal_mode=MEMORY")
+        try:
+            with self.transaction():
+                yield self
+        finally:
+            if journal_mode != "wal":
+                conn.execute("PRAGMA journal_mode={}".format(journal_mode))
+            conn.execute("PRAGMA synchronous={}".format(synchronous))
+
+    def _read_blob(self, name):
+        """Return `(sz, data)` for the file *name* or `None`."""
+        return self._cursor.execute(_SQLAR_READ, (name,)).fetchone()
+
+    @contextmanager
+    def _committing(self):
+        """Use the connection, committing on exit unless in a `transaction`."""
+        if self._in_transaction:
+            yield self._conn
+        else:
+            with self._conn as c:
+                yield c
+
+    def _insert(self, row):
+        with self._committing() as c:
+            c.execute(_SQLAR_INSERT, row)
 
     def __enter__(self):
         return self
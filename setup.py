@@ -19,6 +19,11 @@ The module requires the zlib and sqlite3 support, but has no external dependenci
     license='MIT',
     packages=find_packages(),
     python_requires='>=3',
+    extras_require={
+        'libdeflate': ['deflate'],
+        'isal': ['isal'],
+        'zstd': ['zstandard'],
+    },
     classifiers=[
         "License :: OSI Approved :: MIT License",
         "Programming Language :: Python :: 3"
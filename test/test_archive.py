@@ -1,8 +1,11 @@
 import unittest
-from unittest.mock import patch, mock_open, call
+from unittest.mock import patch, mock_open
 
-import binascii
+import io
+import os
 import sqlite3
+import tempfile
+import threading
 from collections import namedtuple
 from datetime import datetime, timezone
 from pathlib import Path
@@ -18,6 +21,35 @@ class ArchiveTestCase(unittest.TestCase):
             "in-memory archive created with sqlar table"
         )
     
+    def test_is_sqlar_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = Path(tmp) / "test.sqlar"
+            with archive.SQLiteArchive(filename, mode="rwc"):
+                pass
+
+            self.assertTrue(archive.is_sqlar(filename))
+            self.assertTrue(archive.is_sqlar(str(filename)))
+
+    def test_make_uri_follows_cwd(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            try:
+                first = archive._make_uri("test.sqlar", "ro")
+                os.chdir(tmp)
+                second = archive._make_uri("test.sqlar", "ro")
+            finally:
+                os.chdir(cwd)
+
+        self.assertEqual(first, Path(cwd, "test.sqlar").as_uri() + "?mode=ro")
+        self.assertEqual(second, Path(tmp, "test.sqlar").as_uri() + "?mode=ro")
+
+    def test_is_sqlar_not_a_database(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = Path(tmp) / "garbage.sqlar"
+            filename.write_bytes(b"this is not a database" * 100)
+
+            self.assertFalse(archive.is_sqlar(filename))
+
     def test_memory_archive_sqlar(self):
         with archive.SQLiteArchive(":memory:") as ar:
             self.assertTrue(
@@ -79,6 +111,84 @@ class MemoryDatabaseTestCase(unittest.TestCase):
         )
 
 
+class CompressionTestCase(unittest.TestCase):
+
+    def test_roundtrip(self):
+        data = b"Hello World! " * 100
+        compressed = archive.compress_data(data)
+
+        self.assertLess(len(compressed), len(data))
+        self.assertEqual(archive.decompress_data(compressed, len(data)), data)
+
+    def test_incompressible_returned_unchanged(self):
+        data = b"abc"
+        self.assertEqual(archive.compress_data(data), data)
+        self.assertEqual(archive.decompress_data(data, len(data)), data)
+
+    def test_compress_file_streamed(self):
+        data = b"Hello World! " * 1000
+        with patch("pysqlar.archive._STREAM_COMPRESS_SIZE", 0), patch("pysqlar.archive._READ_CHUNK_SIZE", 100):
+            compressed = archive._compress_file(io.BytesIO(data), len(data))
+
+        self.assertLess(len(compressed), len(data))
+        self.assertEqual(archive.decompress_data(compressed, len(data)), data)
+
+    def test_compress_file_incompressible(self):
+        data = bytes(range(256))
+        with patch("pysqlar.archive._STREAM_COMPRESS_SIZE", 0):
+            self.assertEqual(archive._compress_file(io.BytesIO(data), len(data)), data)
+
+    def test_compress_file_gives_up_early(self):
+        # below _PROBE_MIN_SIZE, so only the streamed size check can catch it
+        data = os.urandom(4096)
+        with patch("pysqlar.archive._STREAM_COMPRESS_SIZE", 0), patch("pysqlar.archive._READ_CHUNK_SIZE", 100):
+            self.assertEqual(archive._compress_file(io.BytesIO(data), len(data)), data)
+
+    def test_compressed_format_not_recompressed(self):
+        data = b"\x89PNG\r\n\x1a\n" + bytes(1000)
+        with patch("pysqlar.archive._zlib_compress") as zlib_compress:
+            self.assertEqual(archive.compress_data(data), data)
+            zlib_compress.assert_not_called()
+
+    def test_random_data_not_compressed(self):
+        data = os.urandom(archive._PROBE_MIN_SIZE)
+        with patch("pysqlar.archive._zlib_compress") as zlib_compress:
+            self.assertEqual(archive.compress_data(data), data)
+            zlib_compress.assert_not_called()
+
+    def test_compressible_data_probed(self):
+        data = b"Hello World! " * archive._PROBE_MIN_SIZE
+        self.assertLess(len(archive.compress_data(data)), len(data))
+
+    @unittest.skipUnless(archive._zstd, "zstandard is not installed")
+    def test_zstd_roundtrip(self):
+        data = b"Hello World! " * 100
+        compressed = archive.compress_data(data, compression=archive.SQLAR_ZSTD)
+
+        self.assertTrue(compressed.startswith(archive._ZSTD_MAGIC))
+        self.assertEqual(archive.decompress_data(compressed, len(data)), data)
+        self.assertEqual(b"".join(archive._iter_decompressed(compressed, len(data))), data)
+
+    @unittest.skipUnless(archive._zstd, "zstandard is not installed")
+    def test_zstd_compressor_per_thread(self):
+        def compress():
+            archive._zstd_compress(b"Hello World! " * 100, 3)
+            compressors.append(archive._zstd_local.compressors[3])
+
+        compressors = []
+        compress()
+        thread = threading.Thread(target=compress)
+        thread.start()
+        thread.join()
+
+        self.assertIsNot(compressors[0], compressors[1])
+
+    def test_zstd_missing(self):
+        with patch("pysqlar.archive._zstd", None):
+            with self.assertRaises(archive.SQLiteArchiveException):
+                archive.compress_data(b"Hello World! " * 100, compression=archive.SQLAR_ZSTD)
+
+
 SQLAR_TABLE_INFO_RESULT = [
     (0, "name", "TEXT", 0, None, 1),
     (1, "mode", "INT", 0, None, 0),
@@ -102,6 +212,7 @@ class ArchiveMockedSQLiteTestCase(unittest.TestCase):
         sqlpatcher = patch("pysqlar.archive.sqlite3")
         self.mocksql = sqlpatcher.start()
         self.mocksql.OperationalError = sqlite3.OperationalError
+        self.mocksql.DatabaseError = sqlite3.DatabaseError
 
         ospatcher = patch("pysqlar.archive.os")
         mockos = ospatcher.start()
@@ -156,6 +267,10 @@ class ArchiveMockedSQLiteTestCase(unittest.TestCase):
             self.fail("SQLiteArchive raised exception on correct sqlar schema")
 
 
+PYTHON_MEMBER = ("example/python.py", b'print("Hello World!")\n', 1578096131)
+TEXT_MEMBER = ("example/text.txt", b"Fantastic prose\n", 1578096145)
+
+
 class SQLiteArchiveWithDataTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -202,62 +317,232 @@ class SQLiteArchiveWithDataTestCase(unittest.TestCase):
         with self.assertRaises(NotImplementedError):
             self.sqlar.open("filename.txt")
 
+    def chdir(self, path):
+        cwd = os.getcwd()
+        os.chdir(path)
+        self.addCleanup(os.chdir, cwd)
+
+    def assertExtracted(self, path, members):
+        for name, content, mtime in members:
+            complete_path = Path(path) / name
+            self.assertEqual(complete_path.read_bytes(), content)
+            self.assertEqual(complete_path.stat().st_mode & 0o777, 438)
+            self.assertEqual(int(complete_path.stat().st_mtime), mtime)
+
     def test_extract(self):
-        with patch("pysqlar.archive._decompress_row") as decompress_row:
+        with tempfile.TemporaryDirectory() as tmp:
+            self.chdir(tmp)
 
             self.sqlar.extract("example/python.py")
 
-            decompress_row.assert_called_with(
-                Path(),
-                ('example/python.py', 438, 1578096131, 22, binascii.unhexlify("7072696e74282248656c6c6f20576f726c642122290a"))
-            )
-    
+            self.assertExtracted(tmp, [PYTHON_MEMBER])
+            self.assertFalse((Path(tmp) / "example/text.txt").exists())
+
     def test_extract_with_path(self):
-        with patch("pysqlar.archive._decompress_row") as decompress_row:
+        with tempfile.TemporaryDirectory() as tmp:
+            self.sqlar.extract("example/python.py", Path(tmp) / "folder")
 
-            self.sqlar.extract("example/python.py", "folder")
+            self.assertExtracted(Path(tmp) / "folder", [PYTHON_MEMBER])
 
-            decompress_row.assert_called_with(
-                Path("folder"),
-                ('example/python.py', 438, 1578096131, 22, binascii.unhexlify("7072696e74282248656c6c6f20576f726c642122290a"))
-            )
+    def test_extract_deflated(self):
+        self.sqlar.writestr("deflated.txt", TEXT_MEMBER[1] * 100, unix_mode=438, compression=archive.SQLAR_DEFLATED)
+        with tempfile.TemporaryDirectory() as tmp:
+            self.sqlar.extract("deflated.txt", tmp)
+
+            self.assertEqual((Path(tmp) / "deflated.txt").read_bytes(), TEXT_MEMBER[1] * 100)
+
+    def test_extract_overwrites(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            complete_path = Path(tmp) / "example/python.py"
+            complete_path.parent.mkdir()
+            complete_path.write_bytes(b"old content that is longer than the new one")
+            complete_path.chmod(0o600)
+
+            self.sqlar.extract("example/python.py", tmp)
+
+            self.assertExtracted(tmp, [PYTHON_MEMBER])
+
+    def test_extract_symlink(self):
+        self.sqlar.sql("INSERT INTO sqlar VALUES ('example/link', 511, 1578096145, -1, 'text.txt');")
+        with tempfile.TemporaryDirectory() as tmp:
+            self.sqlar.extractall(tmp)
+
+            self.assertEqual(os.readlink(Path(tmp) / "example/link"), "text.txt")
+            self.assertEqual((Path(tmp) / "example/link").read_bytes(), TEXT_MEMBER[1])
+
+    def test_extract_symlink_twice(self):
+        self.sqlar.sql("INSERT INTO sqlar VALUES ('example/link', 511, 1578096145, -1, 'text.txt');")
+        with tempfile.TemporaryDirectory() as tmp:
+            self.sqlar.extractall(tmp)
+            self.sqlar.extractall(tmp, workers=1)
+
+            self.assertEqual(os.readlink(Path(tmp) / "example/link"), "text.txt")
+            self.assertExtracted(tmp, [PYTHON_MEMBER, TEXT_MEMBER])
+
+    def test_extract_through_symlink_refused(self):
+        with tempfile.TemporaryDirectory() as tmp, tempfile.TemporaryDirectory() as outside:
+            self.sqlar.sql("INSERT INTO sqlar VALUES ('link', 511, 1578096145, -1, ?);", outside)
+            self.sqlar.extractall(tmp)
+            self.sqlar.writestr("link/pwn.txt", "pwned")
+
+            for workers in (1, 2):
+                with self.assertRaises(archive.SQLiteArchiveException):
+                    self.sqlar.extractall(tmp, workers=workers)
+            with self.assertRaises(archive.SQLiteArchiveException):
+                self.sqlar.extract("link/pwn.txt", tmp)
+
+            self.assertSequenceEqual(os.listdir(outside), [])
+
+    def test_extract_symlink_after_members(self):
+        with tempfile.TemporaryDirectory() as tmp, tempfile.TemporaryDirectory() as outside:
+            self.sqlar.sql("INSERT INTO sqlar VALUES ('link', 511, 1578096145, -1, ?);", outside)
+            self.sqlar.writestr("link/pwn.txt", "pwned")
+
+            with self.assertRaises(OSError):
+                self.sqlar.extractall(tmp, workers=1)
+
+            self.assertEqual((Path(tmp) / "link/pwn.txt").read_bytes(), b"pwned")
+            self.assertSequenceEqual(os.listdir(outside), [])
+
+    def test_extract_replaces_symlink_with_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            target = Path(tmp) / "target.txt"
+            target.write_bytes(b"target")
+            complete_path = Path(tmp) / "example/python.py"
+            complete_path.parent.mkdir()
+            complete_path.symlink_to(target)
+
+            self.sqlar.extract("example/python.py", tmp)
+
+            self.assertFalse(complete_path.is_symlink())
+            self.assertEqual(target.read_bytes(), b"target")
+
+    def test_iter_decompressed_bounded_chunks(self):
+        data = bytes(10 * archive._CHUNK_SIZE)
+        chunks = list(archive._iter_decompressed(archive.compress_data(data), len(data)))
+
+        self.assertEqual(b"".join(chunks), data)
+        self.assertLessEqual(max(len(chunk) for chunk in chunks), archive._CHUNK_SIZE)
+
+    def test_extractall_deflated_whole_buffer(self):
+        self.sqlar.writestr("deflated.txt", TEXT_MEMBER[1] * 100, unix_mode=438, compression=archive.SQLAR_DEFLATED)
+        with tempfile.TemporaryDirectory() as tmp, patch("pysqlar.archive._FAST_ZLIB", True):
+            self.sqlar.extractall(tmp, members=["deflated.txt"], workers=2)
+
+            self.assertEqual((Path(tmp) / "deflated.txt").read_bytes(), TEXT_MEMBER[1] * 100)
+
+    def test_extract_directory(self):
+        self.sqlar.sql("INSERT INTO sqlar VALUES ('example/empty', 511, 1578096145, 0, NULL);")
+        with tempfile.TemporaryDirectory() as tmp:
+            self.sqlar.extract("example/empty", tmp)
+
+            self.assertTrue((Path(tmp) / "example/empty").is_dir())
 
     def test_extractall(self):
-        with patch("pysqlar.archive._decompress_row") as decompress_row:
+        with tempfile.TemporaryDirectory() as tmp:
+            self.chdir(tmp)
 
             self.sqlar.extractall()
-            
-            decompress_row.assert_has_calls([
-                call(
-                    Path(),
-                    ('example/python.py', 438, 1578096131, 22, binascii.unhexlify("7072696e74282248656c6c6f20576f726c642122290a"))
-                ),
-                call(
-                    Path(),
-                    ('example/text.txt', 438, 1578096145, 16, binascii.unhexlify("46616e7461737469632070726f73650a"))
-                )
-            ])
-    
+
+            self.assertExtracted(tmp, [PYTHON_MEMBER, TEXT_MEMBER])
+
     def test_extractall_with_path(self):
-        with patch("pysqlar.archive._decompress_row") as decompress_row:
-
-            self.sqlar.extractall("folder")
-
-            decompress_row.assert_has_calls([
-                call(
-                    Path("folder"),
-                    ('example/python.py', 438, 1578096131, 22, binascii.unhexlify("7072696e74282248656c6c6f20576f726c642122290a"))
-                ),
-                call(
-                    Path("folder"),
-                    ('example/text.txt', 438, 1578096145, 16, binascii.unhexlify("46616e7461737469632070726f73650a"))
-                )
-            ])
+        with tempfile.TemporaryDirectory() as tmp:
+            self.sqlar.extractall(Path(tmp) / "folder")
+
+            self.assertExtracted(Path(tmp) / "folder", [PYTHON_MEMBER, TEXT_MEMBER])
+
+    def test_extractall_members(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.sqlar.extractall(tmp, members=["example/text.txt"])
+
+            self.assertExtracted(tmp, [TEXT_MEMBER])
+            self.assertFalse((Path(tmp) / "example/python.py").exists())
+
+    def test_extractall_members_inline(self):
+        with tempfile.TemporaryDirectory() as tmp, patch.object(self.sqlar, "_conn", wraps=self.sqlar._conn) as conn:
+            self.sqlar.extractall(tmp, members=["example/text.txt", "example/python.py"], workers=1)
+
+            conn.executemany.assert_not_called()
+            self.assertExtracted(tmp, [PYTHON_MEMBER, TEXT_MEMBER])
+
+    def test_extractall_many_members(self):
+        members = ["example/text.txt"] + ["missing{}".format(i) for i in range(2000)]
+        with tempfile.TemporaryDirectory() as tmp:
+            self.sqlar.extractall(tmp, members=members, workers=1)
+
+            self.assertExtracted(tmp, [TEXT_MEMBER])
+            self.assertFalse((Path(tmp) / "example/python.py").exists())
+
+    def test_extractall_makedirs_once(self):
+        with tempfile.TemporaryDirectory() as tmp, patch("pysqlar.archive.os.makedirs", wraps=os.makedirs) as makedirs:
+            self.sqlar.extractall(tmp, workers=1)
+
+            makedirs.assert_called_once_with(os.path.join(tmp, "example"), exist_ok=True)
+            self.assertExtracted(tmp, [PYTHON_MEMBER, TEXT_MEMBER])
+
+    def test_extractall_serial(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.sqlar.extractall(tmp, workers=1)
+
+            self.assertExtracted(tmp, [PYTHON_MEMBER, TEXT_MEMBER])
+
+    def test_extractall_few_rows_inline(self):
+        with tempfile.TemporaryDirectory() as tmp, patch("pysqlar.archive.ThreadPoolExecutor.map") as pool_map:
+            self.sqlar.extractall(tmp, workers=2)
+
+            pool_map.assert_not_called()
+            self.assertExtracted(tmp, [PYTHON_MEMBER, TEXT_MEMBER])
+
+    def test_extractall_parallel(self):
+        members = [("many/{}.txt".format(i), "file {}".format(i).encode() * 50, 1578096145) for i in range(8)]
+        with self.sqlar.transaction():
+            for name, content, mtime in members:
+                self.sqlar.writestr(name, content, unix_mode=438, mtime=mtime, compression=archive.SQLAR_DEFLATED)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            self.sqlar.extractall(tmp, workers=4)
+
+            self.assertExtracted(tmp, [PYTHON_MEMBER, TEXT_MEMBER] + members)
+
+    def test_extractall_batches(self):
+        with tempfile.TemporaryDirectory() as tmp, patch("pysqlar.archive._EXTRACT_BATCH_BYTES", 1):
+            self.sqlar.extractall(tmp, workers=2)
+
+            self.assertExtracted(tmp, [PYTHON_MEMBER, TEXT_MEMBER])
 
     def test_read(self):
         res = self.sqlar.read("example/python.py")
         self.assertEqual(res, b'print("Hello World!")\n')
 
+    def test_read_no_copy(self):
+        res = self.sqlar.read("example/python.py", copy=False)
+        self.assertIsInstance(res, memoryview)
+        self.assertEqual(res, b'print("Hello World!")\n')
+
+    def test_read_no_copy_compressed(self):
+        self.sqlar.writestr("deflated.txt", TEXT_MEMBER[1] * 100, compression=archive.SQLAR_DEFLATED)
+
+        res = self.sqlar.read("deflated.txt", copy=False)
+
+        self.assertNotIsInstance(res, memoryview)
+        self.assertEqual(res, TEXT_MEMBER[1] * 100)
+
+    def test_read_raw(self):
+        self.sqlar.writestr("deflated.txt", TEXT_MEMBER[1] * 100, compression=archive.SQLAR_DEFLATED)
+
+        data, size = self.sqlar.read("deflated.txt", raw=True)
+
+        self.assertEqual(size, len(TEXT_MEMBER[1] * 100))
+        self.assertEqual(archive.decompress_data(data, size), TEXT_MEMBER[1] * 100)
+
+    @unittest.skipUnless(hasattr(sqlite3.Connection, "blobopen"), "requires Python 3.11")
+    def test_blob(self):
+        with self.sqlar.blob("example/text.txt") as blob:
+            self.assertEqual(blob[:9], b"Fantastic")
+            self.assertEqual(blob.read(), TEXT_MEMBER[1])
+        self.assertIsNone(self.sqlar.blob("missing.txt"))
+
     def test_sql(self):
         res = self.sqlar.sql(
             "SELECT datetime(mtime, 'unixepoch') FROM sqlar WHERE name = ?;",
@@ -269,6 +554,38 @@ class SQLiteArchiveWithDataTestCase(unittest.TestCase):
             datetime.utcfromtimestamp(1578096145).isoformat(sep=" ")
         )
 
+    def test_sql_functions(self):
+        res = self.sqlar.sql(
+            "SELECT sqlar_uncompress(sqlar_compress(?), ?)",
+            TEXT_MEMBER[1] * 100,
+            len(TEXT_MEMBER[1] * 100)
+        )
+        self.assertEqual(res[0][0], TEXT_MEMBER[1] * 100)
+
+    def test_sql_uncompress_non_positive_size(self):
+        # like the sqlite3 shell, the data is returned as is for sz <= 0
+        for size in (0, -1):
+            res = self.sqlar.sql("SELECT sqlar_uncompress(?, ?)", b"text.txt", size)
+            self.assertEqual(res[0][0], b"text.txt")
+
+    def test_copy_from(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = Path(tmp) / "source.sqlar"
+            with archive.SQLiteArchive(filename, mode="rwc") as source:
+                source.writestr("copied.txt", TEXT_MEMBER[1] * 100, unix_mode=438, mtime=1578096145)
+
+            self.sqlar.attach(filename, "source")
+            self.sqlar.copy_from("source", compress=True)
+            self.sqlar.detach("source")
+
+        self.assertEqual(self.sqlar.getinfo("copied.txt"), ("copied.txt", 438, 1578096145, 1600))
+        self.assertEqual(self.sqlar.read("copied.txt"), TEXT_MEMBER[1] * 100)
+        self.assertLess(len(self.sqlar.read("copied.txt", raw=True)[0]), 1600)
+
+    def test_attach_invalid_alias(self):
+        with self.assertRaises(ValueError):
+            self.sqlar.attach("other.sqlar", "x; DROP TABLE sqlar")
+
     def test_testsqlar(self):
         with self.assertRaises(NotImplementedError):
             self.sqlar.testsqlar()
@@ -302,6 +619,17 @@ class SQLiteArchiveNoDataTestCase(unittest.TestCase):
                     b"Hello World!"
                 )
 
+    def test_write_mtime_not_rounded_up(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = Path(tmp) / "test.txt"
+            filename.write_bytes(b"Hello World!")
+            # float seconds would round this up to 1700000001
+            os.utime(filename, ns=(0, 1_700_000_000_999_999_999))
+
+            with archive.SQLiteArchive(":memory:") as ar:
+                ar.write(filename, "test.txt")
+                self.assertEqual(ar.getinfo("test.txt")[2], 1700000000)
+
     def test_writestr(self):
         with archive.SQLiteArchive(":memory:") as ar:
             ar.writestr("test.txt", "Hello World!")
@@ -310,6 +638,214 @@ class SQLiteArchiveNoDataTestCase(unittest.TestCase):
                 b"Hello World!"
             )
 
+    def test_writestr_level_zero(self):
+        data = b"Hello World! " * 100
+        with archive.SQLiteArchive(":memory:", compression=archive.SQLAR_DEFLATED, compress_level=9) as ar:
+            ar.writestr("zero.txt", data, compress_level=0)
+            ar.writestr("stored.txt", data, compression=archive.SQLAR_STORED)
+            ar.writestr("default.txt", data)
+
+            self.assertEqual(len(ar.read("zero.txt", raw=True)[0]), len(archive.compress_data(data, 0)))
+            self.assertEqual(ar.read("stored.txt", raw=True)[0], data)
+            self.assertEqual(len(ar.read("default.txt", raw=True)[0]), len(archive.compress_data(data, 9)))
+
+    def test_writestr_bytes_like(self):
+        with archive.SQLiteArchive(":memory:") as ar:
+            ar.writestr("bytearray.txt", bytearray(b"Hello World!"))
+            ar.writestr("memoryview.txt", memoryview(b"Hello World!"))
+            self.assertEqual(ar.read("bytearray.txt"), b"Hello World!")
+            self.assertEqual(ar.read("memoryview.txt"), b"Hello World!")
+
+    def test_writestr_default_mtime(self):
+        with archive.SQLiteArchive(":memory:") as ar, patch("pysqlar.archive.time.time") as now:
+            now.return_value = 1000.5
+            ar.writestr("first.txt", "first")
+            now.return_value = 2000.5
+            ar.writestr("second.txt", "second")
+            self.assertEqual(ar.getinfo("first.txt")[2], 1000)
+            self.assertEqual(ar.getinfo("second.txt")[2], 2000)
+
+    def test_transaction(self):
+        with archive.SQLiteArchive(":memory:") as ar:
+            with ar.transaction():
+                ar.writestr("a.txt", "a")
+                ar.writestr("b.txt", "b")
+            self.assertEqual(ar.read("a.txt"), b"a")
+            self.assertEqual(ar.read("b.txt"), b"b")
+
+    def test_transaction_rollback(self):
+        with archive.SQLiteArchive(":memory:") as ar:
+            with self.assertRaises(TestException):
+                with ar.transaction():
+                    ar.writestr("a.txt", "a")
+                    raise TestException()
+            self.assertSequenceEqual(ar.namelist(), [])
+
+    def test_transaction_reads_own_writes(self):
+        with archive.SQLiteArchive(":memory:") as ar:
+            with self.assertRaises(FileNotFoundError):
+                with ar.transaction():
+                    ar.writestr("a.txt", "a")
+                    self.assertEqual(ar.read("a.txt"), b"a")
+                    # sql must not commit the transaction half way
+                    self.assertEqual(ar.sql("SELECT count(*) FROM sqlar"), [(1,)])
+                    ar.writemany(["does-not-exist.txt"])
+            self.assertSequenceEqual(ar.namelist(), [])
+
+    def test_bulk(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = Path(tmp) / "test.sqlar"
+            pragmas = {"journal_mode": "DELETE", "synchronous": "FULL"}
+            with archive.SQLiteArchive(filename, mode="rwc", pragmas=pragmas) as ar:
+                with ar.bulk():
+                    ar.writestr("a.txt", "a")
+                    self.assertEqual(ar.sql("PRAGMA synchronous")[0][0], 0)
+                    self.assertEqual(ar.sql("PRAGMA journal_mode")[0][0], "memory")
+                self.assertEqual(ar.read("a.txt"), b"a")
+                self.assertEqual(ar.sql("PRAGMA synchronous")[0][0], 2)
+                self.assertEqual(ar.sql("PRAGMA journal_mode")[0][0], "delete")
+
+    def test_bulk_in_transaction(self):
+        with archive.SQLiteArchive(":memory:") as ar:
+            with ar.transaction():
+                ar.writestr("a.txt", "a")
+                with ar.bulk():
+                    ar.writestr("b.txt", "b")
+                    with ar.bulk():
+                        ar.writestr("c.txt", "c")
+            self.assertSequenceEqual(sorted(ar.namelist()), ["a.txt", "b.txt", "c.txt"])
+            self.assertEqual(ar.sql("PRAGMA synchronous")[0][0], 1)
+
+    def test_bulk_rollback(self):
+        with archive.SQLiteArchive(":memory:") as ar:
+            with self.assertRaises(TestException):
+                with ar.bulk():
+                    ar.writestr("a.txt", "a")
+                    raise TestException()
+            self.assertSequenceEqual(ar.namelist(), [])
+            self.assertEqual(ar.sql("PRAGMA synchronous")[0][0], 1)
+
+    def test_writemany(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            first = Path(tmp) / "first.txt"
+            first.write_bytes(b"first")
+            second = Path(tmp) / "second.txt"
+            second.write_bytes(b"second")
+
+            with archive.SQLiteArchive(":memory:") as ar:
+                ar.writemany([(first, "first.txt"), (second, "second.txt")])
+                self.assertEqual(ar.read("first.txt"), b"first")
+                self.assertEqual(ar.read("second.txt"), b"second")
+
+    def test_writemany_in_transaction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            first = Path(tmp) / "first.txt"
+            first.write_bytes(b"first")
+
+            with archive.SQLiteArchive(":memory:") as ar:
+                with ar.transaction():
+                    ar.writestr("text.txt", "text")
+                    ar.writemany([(first, "first.txt")])
+                self.assertSequenceEqual(sorted(ar.namelist()), ["first.txt", "text.txt"])
+
+    def test_default_pragmas(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = Path(tmp) / "test.sqlar"
+            with archive.SQLiteArchive(filename, mode="rwc") as ar:
+                self.assertEqual(ar.sql("PRAGMA journal_mode")[0][0], "delete")
+                self.assertEqual(ar.sql("PRAGMA synchronous")[0][0], 1)
+
+            with archive.SQLiteArchive(filename) as ar:
+                self.assertEqual(ar.sql("PRAGMA cache_size")[0][0], -65536)
+                self.assertEqual(ar.sql("PRAGMA page_size")[0][0], 65536)
+                self.assertEqual(ar.sql("PRAGMA auto_vacuum")[0][0], 2)
+                # 0 if SQLite was built without memory-mapped I/O
+                self.assertIn(ar.sql("PRAGMA mmap_size")[0][0], (0, 1073741824))
+
+    def test_closed_archive_single_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = Path(tmp) / "test.sqlar"
+            with archive.SQLiteArchive(filename, mode="rwc") as ar:
+                ar.writestr("a.txt", "a")
+            # overlapping writable handles
+            first = archive.SQLiteArchive(filename, mode="rw")
+            second = archive.SQLiteArchive(filename, mode="rw")
+            first.close()
+            second.close()
+
+            self.assertTrue(archive.is_sqlar(filename))
+            with archive.SQLiteArchive(filename, mode="ro") as ar:
+                self.assertEqual(ar.sql("PRAGMA journal_mode")[0][0], "delete")
+                self.assertEqual(ar.read("a.txt"), b"a")
+
+            self.assertSequenceEqual(os.listdir(tmp), ["test.sqlar"])
+
+    def test_not_an_archive_untouched(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = Path(tmp) / "test.db"
+            with sqlite3.connect(filename) as conn:
+                conn.execute("CREATE TABLE sqlar(name TEXT)")
+            conn.close()
+
+            with self.assertRaises(archive.SQLiteArchiveException):
+                archive.SQLiteArchive(filename, mode="rw", pragmas={"journal_mode": "WAL"})
+
+            with sqlite3.connect(filename) as conn:
+                self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "delete")
+            conn.close()
+
+    def test_explicit_wal_kept(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = Path(tmp) / "test.sqlar"
+            pragmas = {"journal_mode": "WAL"}
+            with archive.SQLiteArchive(filename, mode="rwc", pragmas=pragmas):
+                pass
+
+            with archive.SQLiteArchive(filename, mode="rw", pragmas={"journal_mode": None}) as ar:
+                self.assertEqual(ar.sql("PRAGMA journal_mode")[0][0], "wal")
+
+    def test_close_vacuums(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = Path(tmp) / "test.sqlar"
+            with archive.SQLiteArchive(filename, mode="rwc") as ar:
+                ar.writestr("a.bin", os.urandom(1024 * 1024))
+            size = filename.stat().st_size
+
+            with archive.SQLiteArchive(filename, mode="rw") as ar:
+                ar.sql("DELETE FROM sqlar")
+
+            self.assertLess(filename.stat().st_size, size // 4)
+
+    def test_page_size_existing_archive(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = Path(tmp) / "test.sqlar"
+            with archive.SQLiteArchive(filename, mode="rwc", pragmas={"page_size": 4096}):
+                pass
+
+            with archive.SQLiteArchive(filename, mode="rw") as ar:
+                self.assertEqual(ar.sql("PRAGMA page_size")[0][0], 4096)
+
+    def test_pragmas_override(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = Path(tmp) / "test.sqlar"
+            pragmas = {"journal_mode": None, "synchronous": "FULL"}
+            with archive.SQLiteArchive(filename, mode="rwc", pragmas=pragmas) as ar:
+                self.assertEqual(ar.sql("PRAGMA journal_mode")[0][0], "delete")
+                self.assertEqual(ar.sql("PRAGMA synchronous")[0][0], 2)
+
+    def test_namelist_empty(self):
+        with archive.SQLiteArchive(":memory:") as ar:
+            self.assertEqual(ar.namelist(), [])
+
+    def test_to_arcname(self):
+        self.assertEqual(archive._to_arcname("dir/file.txt"), "dir/file.txt")
+        self.assertEqual(archive._to_arcname(Path("dir") / "file.txt"), "dir/file.txt")
+        self.assertEqual(archive._to_arcname("/dir//./file.txt"), "dir/file.txt")
+        self.assertEqual(archive._to_arcname("dir/"), "dir")
+        self.assertEqual(archive._to_arcname("./dir/."), "dir")
+        self.assertEqual(archive._to_arcname("."), "")
+        self.assertEqual(archive._to_arcname(".hidden/..name"), ".hidden/..name")
+
     def test_context_manager(self):
         try:
             with archive.SQLiteArchive(":memory:") as ar: